@@ -1,45 +1,71 @@
+import atexit
 import json
 import os
 import random
 import re
+import secrets
 import shutil
 import subprocess
 import sys
 import time
-import urllib.error
-import urllib.request
 import hashlib
+import functools
+import itertools
 import math
-from typing import Any, Dict, List, Optional, Set, Tuple
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+import httpx
+import orjson
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
+try:
+    import h2  # noqa: F401
+
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
 import torch
 import torch.nn as nn
 import torch.optim as optim
 
 
+_ENV_LINE_RE = re.compile(r"^\s*(?:export\s+)?([A-Za-z_][A-Za-z0-9_]*)\s*=\s*(.*?)\s*$")
+
+
 def load_env_file(path: str) -> None:
     if not os.path.exists(path):
         return
     try:
         with open(path, "r", encoding="utf-8") as f:
-            lines = f.readlines()
+            lines = f.read().splitlines()
     except Exception:
         return
+    loaded: Dict[str, str] = {}
     for line in lines:
-        raw = line.strip()
-        if not raw or raw.startswith("#"):
+        match = _ENV_LINE_RE.match(line)
+        if match is None:
             continue
-        if raw.startswith("export "):
-            raw = raw[7:].strip()
-        if "=" not in raw:
-            continue
-        key, value = raw.split("=", 1)
-        key = key.strip()
-        value = value.strip()
-        if not key or key in os.environ:
+        key, value = match.groups()
+        if key in loaded or key in os.environ:
             continue
         if len(value) >= 2 and value[0] == value[-1] and value[0] in {"'", '"'}:
             value = value[1:-1]
-        os.environ[key] = value
+        loaded[key] = value
+    os.environ.update(loaded)
+
+
+def _parse_int(raw: str, default: int) -> int:
+    try:
+        return int(raw)
+    except Exception:
+        return default
+
+
+TOOLSERVER_PIPELINE_WINDOW = 32 * 1024
+# Matches the default Linux pipe capacity, so a large tool result is read in pipe-sized chunks.
+TOOLSERVER_PIPE_BUFSIZE = 64 * 1024
 
 
 class ToolServerClient:
@@ -47,42 +73,63 @@ class ToolServerClient:
         self.proc = proc
         self._next_id = 1
         self.debug_enabled = debug_enabled
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._inflight: Dict[str, int] = {}
+        self._inflight_bytes = 0
 
-    def request(self, method: str, params: Optional[Dict[str, Any]] = None) -> Any:
+    def send(self, method: str, params: Optional[Dict[str, Any]] = None) -> str:
         req_id = str(self._next_id)
         self._next_id += 1
         payload = {"id": req_id, "method": method, "params": params or {}}
         if self.debug_enabled:
             print(f"\n========== TOOLSERVER 请求 (id={req_id}) ==========", file=sys.stderr)
             print(
-                json.dumps(
-                    {"method": method, "params": params or {}},
-                    ensure_ascii=False,
-                    indent=2,
-                ),
+                orjson.dumps({"method": method, "params": params or {}}, option=orjson.OPT_INDENT_2).decode("utf-8"),
                 file=sys.stderr,
             )
-        self.proc.stdin.write((json.dumps(payload) + "\n").encode("utf-8"))
+        data = orjson.dumps(payload) + b"\n"
+        # Keep unread requests below the pipe buffer so neither side can block on a full pipe.
+        while self._inflight and self._inflight_bytes + len(data) > TOOLSERVER_PIPELINE_WINDOW:
+            self._read_response()
+        self.proc.stdin.write(data)
         self.proc.stdin.flush()
+        self._inflight[req_id] = len(data)
+        self._inflight_bytes += len(data)
+        return req_id
 
+    def _read_response(self) -> None:
         line = self.proc.stdout.readline()
         if not line:
             raise RuntimeError("toolserver exited")
-        resp = json.loads(line.decode("utf-8"))
+        resp = orjson.loads(line)
+        resp_id = resp.get("id")
         if self.debug_enabled:
-            print(f"\n========== TOOLSERVER 响应 (id={req_id}) ==========", file=sys.stderr)
-            print(json.dumps(resp, ensure_ascii=False, indent=2), file=sys.stderr)
-        if resp.get("id") != req_id:
-            raise RuntimeError(f"mismatched response id: expected {req_id}, got {resp.get('id')}")
+            print(f"\n========== TOOLSERVER 响应 (id={resp_id}) ==========", file=sys.stderr)
+            print(orjson.dumps(resp, option=orjson.OPT_INDENT_2).decode("utf-8"), file=sys.stderr)
+        if resp_id not in self._inflight:
+            raise RuntimeError(f"mismatched response id: expected one of {sorted(self._inflight)}, got {resp_id}")
+        self._inflight_bytes -= self._inflight.pop(resp_id)
+        self._pending[resp_id] = resp
+
+    def recv_until(self, req_id: str) -> Any:
+        while req_id not in self._pending:
+            self._read_response()
+        resp = self._pending.pop(req_id)
         if resp.get("error"):
             raise RuntimeError(resp["error"]["message"])
         return resp.get("result")
 
+    def request(self, method: str, params: Optional[Dict[str, Any]] = None) -> Any:
+        return self.recv_until(self.send(method, params))
+
     def list_tools(self) -> Any:
         return self.request("list_tools")
 
+    def send_call_tool(self, name: str, input_obj: Dict[str, Any]) -> str:
+        return self.send("call_tool", {"name": name, "input": input_obj})
+
     def call_tool(self, name: str, input_obj: Dict[str, Any]) -> Any:
-        return self.request("call_tool", {"name": name, "input": input_obj})
+        return self.recv_until(self.send_call_tool(name, input_obj))
 
 
 Message = Dict[str, Any]
@@ -90,6 +137,8 @@ ToolCall = Dict[str, Any]
 
 
 class TokenUsage:
+    __slots__ = ("input_tokens", "output_tokens", "total_tokens")
+
     def __init__(self, input_tokens: int = 0, output_tokens: int = 0, total_tokens: int = 0):
         self.input_tokens = input_tokens
         self.output_tokens = output_tokens
@@ -116,6 +165,8 @@ class ProviderResponse:
 
 
 class ProviderEvent:
+    __slots__ = ("event_type", "content", "tool_call", "response", "error")
+
     def __init__(
         self,
         event_type: str,
@@ -352,7 +403,7 @@ def _truncate_text(value: str, max_len: int) -> str:
 
 def _safe_json(value: Any, max_len: int = 3000) -> str:
     try:
-        text = json.dumps(value, ensure_ascii=False, indent=2)
+        text = orjson.dumps(value, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode("utf-8")
     except Exception:
         text = str(value)
     return _truncate_text(text, max_len)
@@ -580,68 +631,224 @@ def emit_activity_hud(
     print("\n".join(lines), file=sys.stderr)
 
 
+class _StreamingToolCall:
+    __slots__ = ("id", "name", "arguments")
+
+    def __init__(self) -> None:
+        self.id = ""
+        self.name = ""
+        self.arguments: List[str] = []
+
+    def to_tool_call(self) -> ToolCall:
+        return {"id": self.id, "name": self.name, "arguments": "".join(self.arguments)}
+
+
+CONTEXT_BYTES_PER_TOKEN = 3
+
+
+class MessageHistory:
+    def __init__(self, messages: Optional[Iterable[Message]] = None, pinned: int = 0):
+        self.pinned: List[Message] = []
+        self._pinned_encoded: List[bytes] = []
+        self.window: Deque[Message] = deque()
+        self._window_encoded: Deque[bytes] = deque()
+        self.encoded_size = 0
+        self.total_appended = 0
+        for message in messages or []:
+            self.append(message)
+        while len(self.pinned) < pinned and self.window:
+            self.pinned.append(self.window.popleft())
+            self._pinned_encoded.append(self._window_encoded.popleft())
+
+    def __len__(self) -> int:
+        return len(self.pinned) + len(self.window)
+
+    @property
+    def messages(self) -> List[Message]:
+        return self.pinned + list(self.window)
+
+    def last(self) -> Optional[Message]:
+        if self.window:
+            return self.window[-1]
+        return self.pinned[-1] if self.pinned else None
+
+    def tail(self, count: int) -> List[Message]:
+        if count <= 0:
+            return []
+        return self.messages[-count:]
+
+    def append(self, message: Message) -> None:
+        encoded = orjson.dumps(message)
+        self.window.append(message)
+        self._window_encoded.append(encoded)
+        self.encoded_size += len(encoded) + 1
+        self.total_appended += 1
+
+    def extended(self, extra: Iterable[Message]) -> "MessageHistory":
+        history = MessageHistory()
+        history.pinned = self.pinned
+        history._pinned_encoded = self._pinned_encoded
+        history.window = deque(self.window)
+        history._window_encoded = deque(self._window_encoded)
+        history.encoded_size = self.encoded_size
+        history.total_appended = self.total_appended
+        for message in extra:
+            history.append(message)
+        return history
+
+    def encoded(self) -> bytes:
+        return b",".join(itertools.chain(self._pinned_encoded, self._window_encoded))
+
+    def estimated_tokens(self) -> int:
+        return self.encoded_size // CONTEXT_BYTES_PER_TOKEN
+
+    def trim(self, max_tokens: int) -> int:
+        dropped = 0
+        while self.estimated_tokens() > max_tokens:
+            # Drop a whole turn so tool results never lose their assistant tool_calls message.
+            group = 1
+            while group < len(self.window) and self.window[group].get("role") == "tool":
+                group += 1
+            if group >= len(self.window):
+                break
+            for _ in range(group):
+                self.window.popleft()
+                self.encoded_size -= len(self._window_encoded.popleft()) + 1
+            dropped += group
+        return dropped
+
+
+Messages = Union[List[Message], MessageHistory]
+
+
+LLM_MAX_RETRIES = 3
+LLM_BACKOFF_CAP_MS = 30_000
+
+
+def _sleep_backoff(attempt: int, retry_after: Optional[str] = None, base_ms: int = 1000, cap_ms: int = LLM_BACKOFF_CAP_MS) -> None:
+    if retry_after and retry_after.isdigit():
+        time.sleep(int(retry_after))
+        return
+    backoff_ms = min(cap_ms, base_ms << attempt)
+    jitter_ms = (secrets.randbits(10) * backoff_ms) >> 12
+    time.sleep((backoff_ms + jitter_ms) / 1000.0)
+
+
+_PROVIDER_CLIENTS: Dict[str, httpx.Client] = {}
+
+
+def _new_provider_client(base_url: str, api_key: str) -> httpx.Client:
+    return httpx.Client(
+        base_url=base_url,
+        headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
+        timeout=60.0,
+        http2=_HTTP2_AVAILABLE,
+        limits=httpx.Limits(max_keepalive_connections=8, keepalive_expiry=60),
+    )
+
+
+def _shared_provider_client(base_url: str, api_key: str) -> httpx.Client:
+    key = base_url + ":" + hashlib.blake2b(api_key.encode("utf-8"), digest_size=8).hexdigest()
+    client = _PROVIDER_CLIENTS.get(key)
+    if client is None or client.is_closed:
+        client = _new_provider_client(base_url, api_key)
+        _PROVIDER_CLIENTS[key] = client
+    return client
+
+
+_RESPONSE_CACHES: Dict[str, Any] = {}
+
+
+def _response_cache() -> Optional[Any]:
+    if diskcache is None:
+        return None
+    if os.environ.get("AGENT_CACHE", "0").strip().lower() not in {"1", "true", "yes"}:
+        return None
+    cache_dir = os.environ.get("AGENT_CACHE_DIR", "").strip() or os.path.join(os.path.expanduser("~"), ".cache", "agent_demo")
+    cache = _RESPONSE_CACHES.get(cache_dir)
+    if cache is None:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        st = os.stat(cache_dir)
+        # Rows are unpickled on read, so only trust a directory nobody else can write to.
+        if hasattr(os, "getuid") and (st.st_uid != os.getuid() or st.st_mode & 0o022):
+            return None
+        cache = diskcache.Cache(cache_dir)
+        _RESPONSE_CACHES[cache_dir] = cache
+    return cache
+
+
+def close_provider_clients() -> None:
+    for client in _PROVIDER_CLIENTS.values():
+        client.close()
+    _PROVIDER_CLIENTS.clear()
+    for cache in _RESPONSE_CACHES.values():
+        cache.close()
+    _RESPONSE_CACHES.clear()
+
+
+atexit.register(close_provider_clients)
+
+
 class DeepSeekProvider:
-    def __init__(self, api_key: str, base_url: str, model: str):
+    def __init__(self, api_key: str, base_url: str, model: str, client: Optional[httpx.Client] = None):
         self.api_key = api_key
         self.base_url = base_url.rstrip("/")
         self.model = model
+        self._client = client if client is not None else _shared_provider_client(self.base_url, api_key)
+        self._payload_prefix = b'{"model":' + orjson.dumps(model) + b',"messages":['
+        self._tools_ref: Optional[List[Dict[str, Any]]] = None
+        self._tools_encoded = b"[]"
+
+    def _encode_tools(self, tools: List[Dict[str, Any]]) -> bytes:
+        if tools is not self._tools_ref:
+            self._tools_encoded = orjson.dumps(tools)
+            self._tools_ref = tools
+        return self._tools_encoded
+
+    def _build_payload(self, messages: Messages, tools: List[Dict[str, Any]], stream: bool = False) -> bytes:
+        if isinstance(messages, MessageHistory):
+            encoded_messages = messages.encoded()
+        else:
+            encoded_messages = b",".join(orjson.dumps(message) for message in messages)
+        parts = [self._payload_prefix, encoded_messages, b'],"tools":', self._encode_tools(tools), b',"tool_choice":"auto"']
+        if stream:
+            parts.append(b',"stream":true,"stream_options":{"include_usage":true}')
+        parts.append(b"}")
+        return b"".join(parts)
 
-    def _build_payload(self, messages: List[Message], tools: List[Dict[str, Any]]) -> Dict[str, Any]:
-        return {
-            "model": self.model,
-            "messages": messages,
-            "tools": tools,
-            "tool_choice": "auto",
-        }
+    def _request(self, payload: bytes) -> Dict[str, Any]:
+        return self._request_with_retries(payload)
 
-    def _build_stream_payload(self, messages: List[Message], tools: List[Dict[str, Any]]) -> Dict[str, Any]:
-        payload = self._build_payload(messages, tools)
-        payload["stream"] = True
-        payload["stream_options"] = {"include_usage": True}
-        return payload
-
-    def _request(self, payload: Dict[str, Any]) -> Dict[str, Any]:
-        url = self.base_url + "/chat/completions"
-        data = json.dumps(payload).encode("utf-8")
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}",
-        }
-        req = urllib.request.Request(
-            url,
-            data=data,
-            headers=headers,
-            method="POST",
-        )
-        return self._request_with_retries(req)
+    def _request_with_retries(self, payload: bytes) -> Dict[str, Any]:
+        resp = self._send_with_retries(payload)
+        return orjson.loads(resp.content)
 
-    def _request_with_retries(self, req: urllib.request.Request) -> Dict[str, Any]:
+    def _send_with_retries(self, body: bytes, stream: bool = False) -> httpx.Response:
         attempts = 0
         while True:
             attempts += 1
             try:
-                with urllib.request.urlopen(req, timeout=60) as resp:
-                    raw = resp.read()
-                return json.loads(raw.decode("utf-8"))
-            except urllib.error.HTTPError as e:
-                if e.code not in {429, 500}:
+                req = self._client.build_request("POST", "/chat/completions", content=body)
+                resp = self._client.send(req, stream=stream)
+                if stream and resp.is_error:
+                    resp.read()
+                    resp.close()
+                resp.raise_for_status()
+                return resp
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code not in {429, 500}:
                     raise
-                if attempts >= 8:
+                if attempts > LLM_MAX_RETRIES:
                     raise
-                retry_after = e.headers.get("Retry-After")
-                if retry_after and retry_after.isdigit():
-                    sleep_ms = int(retry_after) * 1000
-                else:
-                    backoff = 2000 * (2 ** (attempts - 1))
-                    jitter = int(backoff * random.uniform(0.0, 0.2))
-                    sleep_ms = backoff + jitter
-                time.sleep(sleep_ms / 1000.0)
-            except urllib.error.URLError:
-                if attempts >= 8:
+                retry_after = e.response.headers.get("Retry-After")
+                # Honour Retry-After in full; if it exceeds the cap, give up rather than retry early.
+                if retry_after and retry_after.isdigit() and int(retry_after) * 1000 > LLM_BACKOFF_CAP_MS:
+                    raise
+                _sleep_backoff(attempts - 1, retry_after)
+            except httpx.TransportError:
+                if attempts > LLM_MAX_RETRIES:
                     raise
-                backoff = 2000 * (2 ** (attempts - 1))
-                jitter = int(backoff * random.uniform(0.0, 0.2))
-                time.sleep((backoff + jitter) / 1000.0)
+                _sleep_backoff(attempts - 1)
 
     def _parse_tool_calls(self, assistant_msg: Message) -> List[ToolCall]:
         tool_calls = []
@@ -657,119 +864,136 @@ class DeepSeekProvider:
             )
         return tool_calls
 
-    def request(self, messages: List[Message], tools: List[Dict[str, Any]]) -> ProviderResponse:
+    def request(self, messages: Messages, tools: List[Dict[str, Any]]) -> ProviderResponse:
         payload = self._build_payload(messages, tools)
+        cache = _response_cache()
+        cache_key = ""
+        if cache is not None:
+            cache_key = hashlib.blake2b(self.base_url.encode("utf-8") + b"\n" + payload, digest_size=16).hexdigest()
+            cached = cache.get(cache_key)
+            if cached is not None:
+                result = orjson.loads(cached)
+                assistant_msg = result["choices"][0]["message"]
+                return ProviderResponse(assistant_msg, self._parse_tool_calls(assistant_msg), result, TokenUsage())
         result = self._request(payload)
         choice = result["choices"][0]
         assistant_msg = choice["message"]
         tool_calls = self._parse_tool_calls(assistant_msg)
         usage = extract_token_usage(result)
+        if cache is not None:
+            ttl = _memory_env_int("AGENT_CACHE_TTL", 86400, min_value=1, max_value=365 * 86400)
+            cache.set(cache_key, orjson.dumps(result), expire=ttl)
         return ProviderResponse(assistant_msg, tool_calls, result, usage)
 
-    def stream(self, messages: List[Message], tools: List[Dict[str, Any]]) -> List[ProviderEvent]:
-        payload = self._build_stream_payload(messages, tools)
-        url = self.base_url + "/chat/completions"
-        data = json.dumps(payload).encode("utf-8")
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}",
-        }
-        req = urllib.request.Request(
-            url,
-            data=data,
-            headers=headers,
-            method="POST",
-        )
-        attempts = 0
-        while True:
-            attempts += 1
-            try:
-                with urllib.request.urlopen(req, timeout=60) as resp:
-                    return self._parse_stream(resp)
-            except urllib.error.HTTPError as e:
-                if e.code not in {429, 500}:
-                    raise
-                if attempts >= 8:
-                    raise
-                retry_after = e.headers.get("Retry-After")
-                if retry_after and retry_after.isdigit():
-                    sleep_ms = int(retry_after) * 1000
-                else:
-                    backoff = 2000 * (2 ** (attempts - 1))
-                    jitter = int(backoff * random.uniform(0.0, 0.2))
-                    sleep_ms = backoff + jitter
-                time.sleep(sleep_ms / 1000.0)
-            except urllib.error.URLError:
-                if attempts >= 8:
-                    raise
-                backoff = 2000 * (2 ** (attempts - 1))
-                jitter = int(backoff * random.uniform(0.0, 0.2))
-                time.sleep((backoff + jitter) / 1000.0)
+    def stream_events(
+        self,
+        messages: Messages,
+        tools: List[Dict[str, Any]],
+        on_content: Optional[Callable[[str], None]] = None,
+    ) -> Iterator[ProviderEvent]:
+        payload = self._build_payload(messages, tools, stream=True)
+        resp = self._send_with_retries(payload, stream=True)
+        try:
+            yield from self._parse_stream(resp.iter_lines(), True, on_content)
+        finally:
+            resp.close()
 
-    def _parse_stream(self, resp: Any) -> List[ProviderEvent]:
-        events: List[ProviderEvent] = []
-        content = ""
+    def stream(
+        self,
+        messages: Messages,
+        tools: List[Dict[str, Any]],
+        on_content: Optional[Callable[[str], None]] = None,
+    ) -> ProviderResponse:
+        payload = self._build_payload(messages, tools, stream=True)
+        resp = self._send_with_retries(payload, stream=True)
+        try:
+            response = None
+            for event in self._parse_stream(resp.iter_lines(), False, on_content):
+                response = event.response
+            return response
+        finally:
+            resp.close()
+
+    def _parse_stream(
+        self,
+        lines: Iterable[str],
+        emit_events: bool = True,
+        on_content: Optional[Callable[[str], None]] = None,
+    ) -> Iterator[ProviderEvent]:
+        content_parts: List[str] = []
+        content_append = content_parts.append
         finish_reason = ""
         usage = TokenUsage()
-        tool_calls_by_index: Dict[int, ToolCall] = {}
-        while True:
-            line = resp.readline()
-            if not line:
-                break
-            line = line.strip()
-            if not line:
+        tool_calls_by_index: Dict[int, _StreamingToolCall] = {}
+        tool_calls_by_index_get = tool_calls_by_index.get
+        _DATA = "data:"
+        _DATA_LEN = 5
+        _DONE = "[DONE]"
+        _PE = ProviderEvent
+        for line in lines:
+            if not line.startswith(_DATA):
                 continue
-            if not line.startswith(b"data:"):
+            data = line[_DATA_LEN:].strip()
+            if data == _DONE:
+                # Keep draining to the end of the body so the pooled connection can be reused.
                 continue
-            data = line[len(b"data:") :].strip()
-            if data == b"[DONE]":
-                break
             try:
-                chunk = json.loads(data.decode("utf-8"))
+                chunk = orjson.loads(data)
             except Exception:
                 continue
             chunk_usage = chunk.get("usage")
             if isinstance(chunk_usage, dict):
-                usage.add(
-                    TokenUsage(
-                        int(chunk_usage.get("prompt_tokens") or 0),
-                        int(chunk_usage.get("completion_tokens") or 0),
-                        int(chunk_usage.get("total_tokens") or 0),
-                    )
-                )
+                usage.input_tokens += int(chunk_usage.get("prompt_tokens") or 0)
+                usage.output_tokens += int(chunk_usage.get("completion_tokens") or 0)
+                usage.total_tokens += int(chunk_usage.get("total_tokens") or 0)
             for choice in chunk.get("choices") or []:
                 delta = choice.get("delta") or {}
                 delta_content = delta.get("content")
                 if delta_content:
-                    events.append(ProviderEvent("content_delta", content=delta_content))
-                    content += delta_content
+                    if emit_events:
+                        yield _PE("content_delta", delta_content)
+                    if on_content is not None:
+                        on_content(delta_content)
+                    content_append(delta_content)
+                # Fast path: most chunks carry only a content delta.
+                if "tool_calls" not in delta and not choice.get("finish_reason"):
+                    continue
                 if "tool_calls" in delta:
                     for tc in delta.get("tool_calls") or []:
                         idx = tc.get("index", 0)
-                        current = tool_calls_by_index.get(idx, {"id": "", "name": "", "arguments": ""})
-                        if tc.get("id") and not current.get("id"):
-                            current["id"] = tc.get("id")
-                            events.append(ProviderEvent("tool_use_start", tool_call=current.copy()))
+                        current = tool_calls_by_index_get(idx)
+                        if current is None:
+                            current = tool_calls_by_index[idx] = _StreamingToolCall()
+                        if tc.get("id") and not current.id:
+                            current.id = tc.get("id")
+                            if emit_events:
+                                yield _PE("tool_use_start", "", current.to_tool_call())
                         func = tc.get("function") or {}
-                        if func.get("name") and current.get("name") != func.get("name"):
-                            current["name"] = func.get("name")
-                            events.append(ProviderEvent("tool_use_start", tool_call=current.copy()))
-                        if "arguments" in func and func.get("arguments"):
-                            current["arguments"] = current.get("arguments", "") + func.get("arguments")
-                            events.append(ProviderEvent("tool_use_delta", tool_call=current.copy()))
-                        tool_calls_by_index[idx] = current
+                        if func.get("name") and current.name != func.get("name"):
+                            current.name = func.get("name")
+                            if emit_events:
+                                yield _PE("tool_use_start", "", current.to_tool_call())
+                        if func.get("arguments"):
+                            current.arguments.append(func.get("arguments"))
+                            if emit_events:
+                                yield _PE("tool_use_delta", "", current.to_tool_call())
                 if choice.get("finish_reason"):
                     finish_reason = choice.get("finish_reason") or finish_reason
         tool_calls: List[ToolCall] = []
         for idx in sorted(tool_calls_by_index.keys()):
-            tc = tool_calls_by_index[idx]
-            if not tc.get("id"):
+            tc = tool_calls_by_index[idx].to_tool_call()
+            if not tc["id"]:
                 tc["id"] = f"call_{idx}"
             tool_calls.append(tc)
-            events.append(ProviderEvent("tool_use_stop", tool_call=tc.copy()))
-        response = ProviderResponse({"content": content}, tool_calls, {"finish_reason": finish_reason}, usage)
-        events.append(ProviderEvent("complete", response=response))
-        return events
+            if emit_events:
+                yield _PE("tool_use_stop", "", tc.copy())
+        response = ProviderResponse({"content": "".join(content_parts)}, tool_calls, {"finish_reason": finish_reason}, usage)
+        yield _PE("complete", "", None, response)
+
+
+def build_provider(api_key: str, base_url: str, model: str) -> DeepSeekProvider:
+    base_url = base_url.rstrip("/")
+    return DeepSeekProvider(api_key, base_url, model, client=_shared_provider_client(base_url, api_key))
 
 
 def normalize_provider_name(raw_provider: str) -> str:
@@ -781,36 +1005,37 @@ def normalize_provider_name(raw_provider: str) -> str:
     return value
 
 
+PROVIDER_ENV_TABLE: Dict[str, Tuple[Tuple[str, ...], str, str, str, str]] = {
+    "deepseek": (("DEEPSEEK_API_KEY",), "DEEPSEEK_MODEL", "DEEPSEEK_BASE_URL", DEEPSEEK_DEFAULT_MODEL, DEEPSEEK_DEFAULT_BASE_URL),
+    "glm": (("GLM_API_KEY", "ZHIPUAI_API_KEY"), "GLM_MODEL", "GLM_BASE_URL", GLM_DEFAULT_MODEL, GLM_DEFAULT_BASE_URL),
+}
+
+
+PROVIDER_CONTEXT_WINDOWS: Dict[str, int] = {
+    "deepseek": 64000,
+    "glm": 128000,
+}
+
+
 def resolve_provider_config(provider_name: str) -> Dict[str, str]:
-    if provider_name == "deepseek":
-        api_key = os.environ.get("DEEPSEEK_API_KEY", "").strip()
-        if not api_key:
-            raise ValueError("DEEPSEEK_API_KEY is required when LLM_PROVIDER=deepseek.")
-        model = os.environ.get("DEEPSEEK_MODEL", DEEPSEEK_DEFAULT_MODEL).strip() or DEEPSEEK_DEFAULT_MODEL
-        base_url = os.environ.get("DEEPSEEK_BASE_URL", "").strip() or DEEPSEEK_DEFAULT_BASE_URL
-        return {
-            "provider": provider_name,
-            "api_key": api_key,
-            "model": model,
-            "base_url": base_url,
-            "model_label": f"{provider_name}/{model}",
-        }
-    if provider_name == "glm":
-        api_key = os.environ.get("GLM_API_KEY", "").strip()
-        if not api_key:
-            api_key = os.environ.get("ZHIPUAI_API_KEY", "").strip()
-        if not api_key:
-            raise ValueError("GLM_API_KEY or ZHIPUAI_API_KEY is required when LLM_PROVIDER=glm.")
-        model = os.environ.get("GLM_MODEL", GLM_DEFAULT_MODEL).strip() or GLM_DEFAULT_MODEL
-        base_url = os.environ.get("GLM_BASE_URL", "").strip() or GLM_DEFAULT_BASE_URL
-        return {
-            "provider": provider_name,
-            "api_key": api_key,
-            "model": model,
-            "base_url": base_url,
-            "model_label": f"{provider_name}/{model}",
-        }
-    raise ValueError(f"Unsupported LLM_PROVIDER: {provider_name}. Supported values: deepseek, glm.")
+    spec = PROVIDER_ENV_TABLE.get(provider_name)
+    if spec is None:
+        raise ValueError(
+            f"Unsupported LLM_PROVIDER: {provider_name}. Supported values: {', '.join(PROVIDER_ENV_TABLE)}."
+        )
+    api_key_envs, model_env, base_url_env, default_model, default_base_url = spec
+    api_key = next((value for value in (os.environ.get(name, "").strip() for name in api_key_envs) if value), "")
+    if not api_key:
+        raise ValueError(f"{' or '.join(api_key_envs)} is required when LLM_PROVIDER={provider_name}.")
+    model = os.environ.get(model_env, default_model).strip() or default_model
+    base_url = os.environ.get(base_url_env, "").strip() or default_base_url
+    return {
+        "provider": provider_name,
+        "api_key": api_key,
+        "model": model,
+        "base_url": base_url,
+        "model_label": f"{provider_name}/{model}",
+    }
 
 
 def build_tool_schema(tools: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
@@ -859,6 +1084,65 @@ def build_tool_prompt_catalog(tools: List[Dict[str, Any]]) -> str:
         lines.append(f"- {name}：{zh_description}")
     return "\n".join(lines)
 
+
+ToolsKey = Tuple[Tuple[str, str, str, str], ...]
+
+
+def _tools_cache_key(tools: List[Dict[str, Any]]) -> ToolsKey:
+    return tuple(
+        sorted(
+            (
+                str(tool.get("name", "")),
+                str(tool.get("description", "")),
+                orjson.dumps(tool.get("parameters", {}) or {}, option=orjson.OPT_SORT_KEYS).decode("utf-8"),
+                orjson.dumps(tool.get("required", []) or []).decode("utf-8"),
+            )
+            for tool in tools
+        )
+    )
+
+
+def _tools_from_key(tools_key: ToolsKey) -> List[Dict[str, Any]]:
+    return [
+        {"name": name, "description": description, "parameters": orjson.loads(parameters), "required": orjson.loads(required)}
+        for name, description, parameters, required in tools_key
+    ]
+
+
+@functools.lru_cache(maxsize=8)
+def _build_schema_cached(tools_key: ToolsKey) -> List[Dict[str, Any]]:
+    return build_tool_schema(_tools_from_key(tools_key))
+
+
+@functools.lru_cache(maxsize=8)
+def _build_system_prompt_cached(tools_key: ToolsKey, output_dir: str) -> str:
+    tools = _tools_from_key(tools_key)
+    tool_names = [tool.get("name", "") for tool in tools if tool.get("name")]
+    tool_list_text = "，".join(tool_names)
+    tool_catalog_text = build_tool_prompt_catalog(tools)
+    has_skill_search = any(str(tool.get("name", "")).strip() == "skill_search" for tool in tools)
+    has_skill_load = any(str(tool.get("name", "")).strip() == "skill_load" for tool in tools)
+    if has_skill_search and has_skill_load:
+        skill_tool_text = "skill_search、skill_load（已可用）"
+        skill_usage_text = "Skill 使用顺序：先用 skill_search 检索，再用 skill_load 按需加载具体技能正文。"
+    elif has_skill_search or has_skill_load:
+        available_skill_tools = [name for name in ["skill_search", "skill_load"] if name in tool_names]
+        skill_tool_text = "、".join(available_skill_tools) if available_skill_tools else "无"
+        skill_usage_text = "注意：Skill 工具部分可用，优先使用可用项；若缺失另一项，改用常规工具完成任务；如果常规工具无法完成任务，请优先使用 skill 工具来完成任务。"
+    else:
+        skill_tool_text = "无"
+        skill_usage_text = "当前无 Skill 工具，直接使用常规工具链完成任务。"
+    return (
+        "你是一个会使用工具的助手。输入可能是任意问题。需要时调用工具。完成后直接给出答案。回复内容尽量使用中文。\n"
+        f"【工具名称】{tool_list_text}\n"
+        "【工具能力说明】\n"
+        f"{tool_catalog_text}\n"
+        f"【Skill 工具】{skill_tool_text}\n"
+        f"【Skill 使用规则】{skill_usage_text}\n"
+        f"【写文件约束】如果任务需要写文件且存在 write 工具，必须使用 write，且只能写入 {output_dir} 目录。"
+    )
+
+
 def extract_token_usage(result: Any) -> TokenUsage:
     usage = result.get("usage") if isinstance(result, dict) else None
     if not isinstance(usage, dict):
@@ -874,16 +1158,16 @@ def extract_token_usage(result: Any) -> TokenUsage:
 
 
 def normalize_arguments(arguments: Any) -> Dict[str, Any]:
+    if type(arguments) is dict:
+        return arguments
+    if type(arguments) is str:
+        try:
+            args_obj = orjson.loads(arguments)
+        except orjson.JSONDecodeError:
+            return {}
+        return args_obj if type(args_obj) is dict else {}
     if isinstance(arguments, dict):
         return arguments
-    if not isinstance(arguments, str):
-        return {}
-    try:
-        args_obj = json.loads(arguments)
-        if isinstance(args_obj, dict):
-            return args_obj
-    except Exception:
-        return {}
     return {}
 
 
@@ -3902,7 +4186,17 @@ def build_assistant_message(assistant_msg: Message, tool_calls: List[ToolCall])
     return record
 
 
-def response_from_events(events: List[ProviderEvent]) -> ProviderResponse:
+def _echo_stream_content(text: str) -> None:
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+
+def _end_stream_echo(response: ProviderResponse) -> None:
+    if response.message.get("content"):
+        _echo_stream_content("\n")
+
+
+def response_from_events(events: Iterable[ProviderEvent]) -> ProviderResponse:
     response = None
     content = ""
     tool_calls_by_id: Dict[str, ToolCall] = {}
@@ -4186,10 +4480,14 @@ def run_agent(
     mem_store_override: Optional["LightweightMemoryBank"] = None,
     qa_ground_truth: str = "",
     result_sink: Optional[Dict[str, Any]] = None,
+    provider_override: Optional[DeepSeekProvider] = None,
 ) -> int:
     tools = client.list_tools()
-    tool_schema = build_tool_schema(tools)
-    provider = DeepSeekProvider(api_key, base_url, model)
+    tools_key = _tools_cache_key(tools)
+    tool_schema = _build_schema_cached(tools_key)
+    provider = provider_override
+    if provider is None:
+        provider = build_provider(api_key, base_url, model)
     mem_store = mem_store_override
     if mem_store is None:
         mem_store = create_mem_store(
@@ -4204,34 +4502,21 @@ def run_agent(
     qa_hybrid_alpha = _memory_env_float("AGENT_QA_HYBRID_ALPHA", 0.6, min_value=0.0, max_value=1.0)
     qa_ground_truth_env = str(os.environ.get("AGENT_QA_GROUND_TRUTH", "")).strip()
     qa_ground_truth_value = str(qa_ground_truth or qa_ground_truth_env).strip()
-    tool_names = [tool.get("name", "") for tool in tools if tool.get("name")]
-    tool_list_text = "，".join(tool_names)
-    tool_catalog_text = build_tool_prompt_catalog(tools)
-    has_skill_search = any(str(tool.get("name", "")).strip() == "skill_search" for tool in tools)
-    has_skill_load = any(str(tool.get("name", "")).strip() == "skill_load" for tool in tools)
-    if has_skill_search and has_skill_load:
-        skill_tool_text = "skill_search、skill_load（已可用）"
-        skill_usage_text = "Skill 使用顺序：先用 skill_search 检索，再用 skill_load 按需加载具体技能正文。"
-    elif has_skill_search or has_skill_load:
-        available_skill_tools = [name for name in ["skill_search", "skill_load"] if name in tool_names]
-        skill_tool_text = "、".join(available_skill_tools) if available_skill_tools else "无"
-        skill_usage_text = "注意：Skill 工具部分可用，优先使用可用项；若缺失另一项，改用常规工具完成任务；如果常规工具无法完成任务，请优先使用 skill 工具来完成任务。"
-    else:
-        skill_tool_text = "无"
-        skill_usage_text = "当前无 Skill 工具，直接使用常规工具链完成任务。"
-    system_prompt = (
-        "你是一个会使用工具的助手。输入可能是任意问题。需要时调用工具。完成后直接给出答案。回复内容尽量使用中文。\n"
-        f"【工具名称】{tool_list_text}\n"
-        "【工具能力说明】\n"
-        f"{tool_catalog_text}\n"
-        f"【Skill 工具】{skill_tool_text}\n"
-        f"【Skill 使用规则】{skill_usage_text}\n"
-        f"【写文件约束】如果任务需要写文件且存在 write 工具，必须使用 write，且只能写入 {output_dir} 目录。"
+    system_prompt = _build_system_prompt_cached(tools_key, output_dir)
+    history = MessageHistory(
+        [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt},
+        ],
+        pinned=2,
     )
-    messages: List[Message] = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": prompt},
-    ]
+    context_window = _memory_env_int(
+        "AGENT_CONTEXT_WINDOW",
+        PROVIDER_CONTEXT_WINDOWS.get(provider_name, 64000),
+        min_value=1024,
+        max_value=10000000,
+    )
+    context_budget = int(context_window * 0.8) - len(orjson.dumps(tool_schema)) // CONTEXT_BYTES_PER_TOKEN
     _debug_log_block(
         debug_enabled,
         "AGENT 启动配置",
@@ -4286,14 +4571,16 @@ def run_agent(
     extension = max(1, max_steps_extension)
     active_step_limit = max_steps
     step_index = 1
+    last_logged_total = 0
     while step_index <= active_step_limit and step_index <= hard_limit:
+        last_message = history.last()
         _debug_log_block(
             debug_enabled,
             f"STEP {step_index} 开始",
             {
-                "message_count": len(messages),
-                "last_role": messages[-1].get("role") if messages else "",
-                "last_content_preview": _truncate_text(str(messages[-1].get("content", "")) if messages else "", 500),
+                "message_count": len(history),
+                "last_role": last_message.get("role") if last_message else "",
+                "last_content_preview": _truncate_text(str(last_message.get("content", "")) if last_message else "", 500),
                 "usage_before": {
                     "input_tokens": total_usage.input_tokens,
                     "output_tokens": total_usage.output_tokens,
@@ -4301,28 +4588,48 @@ def run_agent(
                 },
             },
         )
-        llm_messages = messages
+        extra_messages: List[Message] = []
         if mem_store is not None:
             query_text = prompt
-            if messages:
-                query_text += "\n" + str(messages[-1].get("content", ""))
+            if last_message:
+                query_text += "\n" + str(last_message.get("content", ""))
             recalled = mem_store.retrieve(query_text, top_k=memory_top_k)
             if recalled:
                 memory_lines = ["可参考的历史记忆（按相关度）："]
                 for i, memory_item in enumerate(recalled, start=1):
                     memory_lines.append(f"{i}. {memory_item}")
                 memory_lines.append("仅在相关时使用这些记忆，不要臆造。")
-                llm_messages = messages + [{"role": "system", "content": "\n".join(memory_lines)}]
+                extra_messages = [{"role": "system", "content": "\n".join(memory_lines)}]
                 _debug_log_block(
                     debug_enabled,
                     f"STEP {step_index} 记忆检索",
                     {"recalled_count": len(recalled), "recalled": recalled, "stats": mem_store.stats()},
                     max_len=5000,
                 )
-        _debug_log_block(debug_enabled, f"LLM 输入 (step {step_index})", llm_messages, max_len=12000)
+        extra_tokens = sum(len(orjson.dumps(m)) + 1 for m in extra_messages) // CONTEXT_BYTES_PER_TOKEN
+        dropped = history.trim(context_budget - extra_tokens)
+        if dropped:
+            _debug_log_block(
+                debug_enabled,
+                f"STEP {step_index} 上下文裁剪",
+                {
+                    "dropped_messages": dropped,
+                    "estimated_tokens": history.estimated_tokens() + extra_tokens,
+                    "budget_tokens": context_budget,
+                },
+            )
+        llm_messages = history.extended(extra_messages) if extra_messages else history
+        if debug_enabled:
+            _debug_log_block(
+                debug_enabled,
+                f"LLM 输入 (step {step_index}, 新增 {history.total_appended - last_logged_total} 条消息)",
+                history.tail(history.total_appended - last_logged_total) + extra_messages,
+                max_len=12000,
+            )
+            last_logged_total = history.total_appended
         try:
-            if stream_enabled:
-                events = provider.stream(llm_messages, tool_schema)
+            if stream_enabled and debug_enabled:
+                events = list(provider.stream_events(llm_messages, tool_schema, on_content=_echo_stream_content))
                 _debug_log_block(
                     debug_enabled,
                     f"LLM 流事件 (step {step_index})",
@@ -4338,10 +4645,14 @@ def run_agent(
                     max_len=12000,
                 )
                 response = response_from_events(events)
+                _end_stream_echo(response)
+            elif stream_enabled:
+                response = provider.stream(llm_messages, tool_schema, on_content=_echo_stream_content)
+                _end_stream_echo(response)
             else:
                 response = provider.request(llm_messages, tool_schema)
-        except urllib.error.HTTPError as e:
-            body = e.read().decode("utf-8", errors="replace")
+        except httpx.HTTPStatusError as e:
+            body = e.response.text
             qa_fail = {"metric_mode": qa_mode, "score": 0.0, "raw_score": 0.0}
             if mem_store is not None:
                 mem_store.finalize_episode("error", qa_reward=-0.2, qa_meta={"metric_mode": qa_mode, "score": 0.0})
@@ -4354,7 +4665,7 @@ def run_agent(
                 answer="",
                 usage=total_usage,
                 model=model_label,
-                error_message=f"LLM request failed: {e.code} {e.reason}\n{body}",
+                error_message=f"LLM request failed: {e.response.status_code} {e.response.reason_phrase}\n{body}",
                 activity=tracker.snapshot(),
                 output_speed=latest_output_speed,
             )
@@ -4386,7 +4697,7 @@ def run_agent(
             {"message": response.message, "tool_calls": response.tool_calls, "raw": response.raw},
             max_len=12000,
         )
-        messages.append(build_assistant_message(response.message, response.tool_calls))
+        history.append(build_assistant_message(response.message, response.tool_calls))
 
         total_usage.add(response.usage)
         speed = get_output_speed(total_usage.output_tokens, speed_cache_path)
@@ -4417,7 +4728,7 @@ def run_agent(
 
         if not response.tool_calls:
             content = response.message.get("content") or ""
-            evidence = _collect_recent_tool_evidence(messages)
+            evidence = _collect_recent_tool_evidence(history.messages)
             qa_result = _evaluate_final_qa(
                 provider=provider,
                 question=prompt,
@@ -4460,6 +4771,7 @@ def run_agent(
         if step_index >= active_step_limit and active_step_limit < hard_limit:
             active_step_limit = min(hard_limit, active_step_limit + extension)
 
+        dispatched: List[Tuple[str, str, Dict[str, Any], str, Optional[Exception]]] = []
         for call in response.tool_calls:
             call_id = call.get("id", "")
             name = call.get("name", "")
@@ -4472,9 +4784,16 @@ def run_agent(
                 max_len=10000,
             )
             tracker.start_tool(call_id, name, args_obj, time.time())
+            try:
+                dispatched.append((call_id, name, args_obj, client.send_call_tool(name, args_obj), None))
+            except Exception as e:
+                dispatched.append((call_id, name, args_obj, "", e))
 
+        for call_id, name, args_obj, req_id, send_error in dispatched:
             try:
-                result = client.call_tool(name, args_obj)
+                if send_error is not None:
+                    raise send_error
+                result = client.recv_until(req_id)
                 if isinstance(result, dict):
                     tool_content = result.get("content", "")
                     is_error = bool(result.get("is_error"))
@@ -4515,7 +4834,7 @@ def run_agent(
                     max_len=3000,
                 )
 
-            messages.append(
+            history.append(
                 {
                     "role": "tool",
                     "tool_call_id": call_id,
@@ -4530,7 +4849,7 @@ def run_agent(
                     "tool_call_id": call_id,
                     "name": name,
                     "tool_message_preview": _truncate_text(tool_content, 1200),
-                    "message_count_after_append": len(messages),
+                    "message_count_after_append": len(history),
                 },
                 max_len=3000,
             )
@@ -4609,6 +4928,7 @@ def run_agent_training(
     memory_backend: str,
     memory_file: str,
     train_output_dir: str,
+    provider_override: Optional[DeepSeekProvider] = None,
 ) -> int:
     outer_epochs = _memory_env_int("AGENT_TRAIN_OUTER_EPOCHS", 1, min_value=1, max_value=1000)
     inner_epochs = _memory_env_int("AGENT_TRAIN_INNER_EPOCHS", 1, min_value=1, max_value=1000)
@@ -4680,6 +5000,7 @@ def run_agent_training(
                     mem_store_override=mem_store,
                     qa_ground_truth=episode_gt,
                     result_sink=episode_result,
+                    provider_override=provider_override,
                 )
                 status_name = str(episode_result.get("status", "error")).strip().lower()
                 if status_name not in inner_status:
@@ -4885,42 +5206,37 @@ def main() -> int:
             prompt = "请回答用户提出的问题。"
     prompt = strip_tool_order_instructions(prompt)
 
-    stream_enabled = os.environ.get("AGENT_STREAM", "").strip().lower() in {"1", "true", "yes"}
-    debug_enabled = os.environ.get("AGENT_DEBUG", "").strip().lower() in {"1", "true", "yes"}
-    max_steps_str = os.environ.get("AGENT_MAX_STEPS", "8").strip()
-    try:
-        max_steps = int(max_steps_str)
-    except Exception:
-        max_steps = 8
-    max_steps_hard_limit_str = os.environ.get("AGENT_MAX_STEPS_HARD_LIMIT", str(max_steps)).strip()
-    max_steps_extension_str = os.environ.get("AGENT_MAX_STEPS_EXTENSION", "8").strip()
-    try:
-        max_steps_hard_limit = int(max_steps_hard_limit_str)
-    except Exception:
-        max_steps_hard_limit = max_steps
-    try:
-        max_steps_extension = int(max_steps_extension_str)
-    except Exception:
-        max_steps_extension = 8
+    env_values = {
+        name: os.environ.get(name, "").strip().lower()
+        for name in (
+            "AGENT_STREAM",
+            "AGENT_DEBUG",
+            "AGENT_MAX_STEPS",
+            "AGENT_MAX_STEPS_HARD_LIMIT",
+            "AGENT_MAX_STEPS_EXTENSION",
+            "AGENT_MEMORY",
+            "AGENT_MEMORY_TOP_K",
+            "AGENT_MEMORY_MAX_ITEMS",
+            "AGENT_MEMORY_MODE",
+            "AGENT_MEMORY_BACKEND",
+        )
+    }
+    stream_enabled = env_values["AGENT_STREAM"] in {"1", "true", "yes"}
+    debug_enabled = env_values["AGENT_DEBUG"] in {"1", "true", "yes"}
+    max_steps = _parse_int(env_values["AGENT_MAX_STEPS"], 8)
+    max_steps_hard_limit = _parse_int(env_values["AGENT_MAX_STEPS_HARD_LIMIT"], max_steps)
+    max_steps_extension = _parse_int(env_values["AGENT_MAX_STEPS_EXTENSION"], 8)
     if max_steps_hard_limit < max_steps:
         max_steps_hard_limit = max_steps
     if max_steps_extension <= 0:
         max_steps_extension = 8
-    memory_enabled = os.environ.get("AGENT_MEMORY", "1").strip().lower() not in {"0", "false", "no"}
-    memory_top_k_str = os.environ.get("AGENT_MEMORY_TOP_K", "3").strip()
-    memory_max_items_str = os.environ.get("AGENT_MEMORY_MAX_ITEMS", "80").strip()
-    try:
-        memory_top_k = int(memory_top_k_str)
-    except Exception:
-        memory_top_k = 3
-    try:
-        memory_max_items = int(memory_max_items_str)
-    except Exception:
-        memory_max_items = 80
-    memory_mode = str(os.environ.get("AGENT_MEMORY_MODE", "controller")).strip().lower()
+    memory_enabled = env_values["AGENT_MEMORY"] not in {"0", "false", "no"}
+    memory_top_k = _parse_int(env_values["AGENT_MEMORY_TOP_K"], 3)
+    memory_max_items = _parse_int(env_values["AGENT_MEMORY_MAX_ITEMS"], 80)
+    memory_mode = env_values["AGENT_MEMORY_MODE"]
     if memory_mode not in {"controller"}:
         memory_mode = "controller"
-    memory_backend = os.environ.get("AGENT_MEMORY_BACKEND", "memskill").strip().lower()
+    memory_backend = env_values["AGENT_MEMORY_BACKEND"]
     if memory_backend not in {"lightweight", "memskill"}:
         memory_backend = "memskill"
     memory_file_raw = os.environ.get("AGENT_MEMORY_FILE", "")
@@ -4957,6 +5273,7 @@ def main() -> int:
 
     proc = subprocess.Popen(
         [toolserver],
+        bufsize=TOOLSERVER_PIPE_BUFSIZE,
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         stderr=None,
@@ -4967,11 +5284,13 @@ def main() -> int:
     assert proc.stdout is not None
 
     client = ToolServerClient(proc, debug_enabled=debug_enabled)
+    provider: Optional[DeepSeekProvider] = None
     try:
         provider_name = normalize_provider_name(os.environ.get("LLM_PROVIDER", "deepseek"))
         train_mode = os.environ.get("AGENT_TRAIN_MODE", "").strip().lower() in {"1", "true", "yes"}
         try:
             provider_config = resolve_provider_config(provider_name)
+            provider = build_provider(provider_config["api_key"], provider_config["base_url"], provider_config["model"])
             hud_enabled = os.environ.get("AGENT_HUD", "").strip().lower() not in {"0", "false", "no"}
             hud_style = os.environ.get("AGENT_HUD_STYLE", "full")
             if train_mode:
@@ -4998,6 +5317,7 @@ def main() -> int:
                     memory_backend,
                     memory_file,
                     train_output_dir,
+                    provider_override=provider,
                 )
             return run_agent(
                 client,
@@ -5021,6 +5341,7 @@ def main() -> int:
                 memory_mode,
                 memory_backend,
                 memory_file,
+                provider_override=provider,
             )
         except ValueError as e:
             result_file = save_agent_result(